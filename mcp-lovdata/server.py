@@ -1,15 +1,44 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
+import atexit
+import functools
+import heapq
+import json
+import math
 import os
 import sys
 import re
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, FrozenSet, Iterator, List, Mapping, Optional, Sequence, Tuple
 
 from lxml import etree
 from mcp.server.fastmcp import FastMCP
 
+try:
+    from selectolax.lexbor import LexborHTMLParser as SelectolaxParser
+except ImportError:  # optional speedup; lxml is used when it is not installed
+    SelectolaxParser = None
+
+try:
+    import msgpack
+except ImportError:  # optional; without it every start re-parses all documents
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:  # optional; stdlib json is used when it is not installed
+    orjson = None
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:  # optional; search falls back to the dict postings
+    np = None
+    sparse = None
+
 # =============================================================================
 # CONFIGURATION
 # =============================================================================
@@ -34,6 +63,20 @@ HTML_ROOT = DATA_ROOT / "html"
 MD_ROOT = DATA_ROOT / "markdown"
 JSON_ROOT = DATA_ROOT / "json"
 
+# Set LOVDATA2_SHARED_CORPUS=1 to keep the loaded corpus in one shared memory
+# segment (see CorpusView) instead of as Python objects on the heap, and
+# LOVDATA2_SHARED_CORPUS_ATTACH=<segment name> to have another server use the
+# segment of a running one instead of loading the corpus itself.
+SHARED_CORPUS = os.environ.get("LOVDATA2_SHARED_CORPUS", "").lower() in {"1", "true", "yes"}
+SHARED_CORPUS_ATTACH = os.environ.get("LOVDATA2_SHARED_CORPUS_ATTACH", "")
+
+# Parsed documents are cached here between runs. Bump the version whenever
+# the dict produced by parse_document changes shape, to ignore old entries.
+# Each parser backend gets its own cache, as their text can differ slightly.
+PARSE_CACHE_VERSION = 4
+PARSE_BACKEND = "selectolax" if SelectolaxParser is not None else "lxml"
+CACHE_DIR = DATA_ROOT / ".parse_cache" / f"v{PARSE_CACHE_VERSION}-{PARSE_BACKEND}"
+
 print(f"[lovdata2-mcp] DATA_ROOT = {DATA_ROOT}", file=sys.stderr)
 print(f"[lovdata2-mcp] XML_ROOT  = {XML_ROOT}", file=sys.stderr)
 
@@ -47,21 +90,45 @@ if not XML_DIR.exists():
 # DOCUMENT LOADING & PARSING
 # =============================================================================
 
-HtmlParser = etree.HTMLParser(encoding="utf-8", recover=True)
+_TOKEN_RE = re.compile(r"\w+")
 
 
 def tokenize(text: str) -> List[str]:
     """Very simple tokenizer for scoring."""
-    return re.findall(r"\w+", text.lower())
+    return _TOKEN_RE.findall(text.lower())
+
+
+@functools.lru_cache(maxsize=4096)
+def tokenize_query(query: str) -> Tuple[str, ...]:
+    """
+    Distinct tokenize() tokens of a query, in first-seen order; cached so
+    repeated queries skip the work. A repeated query word adds nothing.
+    """
+    return tuple(dict.fromkeys(tokenize(query)))
+
+
+# Interned, so all documents of a kind share one string object
+_KIND_BY_PREFIX = {"nl-": sys.intern("law"), "sf-": sys.intern("regulation")}
+_KIND_OTHER = sys.intern("other")
 
 
 def classify_doc_id(doc_id: str) -> str:
     """Classify by filename prefix."""
-    if doc_id.startswith("nl-"):
-        return "law"
-    if doc_id.startswith("sf-"):
-        return "regulation"
-    return "other"
+    return _KIND_BY_PREFIX.get(doc_id[:3], _KIND_OTHER)
+
+
+@functools.lru_cache(maxsize=None)
+def list_related_files(root: Path, suffix: str) -> FrozenSet[Path]:
+    """
+    Return all files with `suffix` under root/xml, relative to root/xml.
+
+    One directory walk per output tree replaces a stat() per document in
+    compute_related_paths. Missing trees simply yield an empty set.
+    """
+    base = root / "xml"
+    if not base.is_dir():
+        return frozenset()
+    return frozenset(p.relative_to(base) for p in base.rglob(f"*{suffix}"))
 
 
 def compute_related_paths(xml_path: Path) -> Dict[str, Optional[str]]:
@@ -77,76 +144,67 @@ def compute_related_paths(xml_path: Path) -> Dict[str, Optional[str]]:
     try:
         rel = xml_path.relative_to(XML_DIR).with_suffix("")  # e.g. sf/sf-20061027-1196
     except ValueError:
-        rel = xml_path.name.rsplit(".", 1)[0]
-
-    html_path = HTML_ROOT / "xml" / rel.with_suffix(".html")
-    md_path = MD_ROOT / "xml" / rel.with_suffix(".md")
-    json_path = JSON_ROOT / "xml" / rel.with_suffix(".json")
+        rel = Path(xml_path.stem)
 
-    def _opt(p: Path) -> Optional[str]:
-        return str(p) if p.exists() else None
+    def _opt(root: Path, suffix: str) -> Optional[str]:
+        target = rel.with_suffix(suffix)
+        if target not in list_related_files(root, suffix):
+            return None
+        return str(root / "xml" / target)
 
     return {
         "xml": str(xml_path),
-        "html": _opt(html_path),
-        "markdown": _opt(md_path),
-        "json": _opt(json_path),
+        "html": _opt(HTML_ROOT, ".html"),
+        "markdown": _opt(MD_ROOT, ".md"),
+        "json": _opt(JSON_ROOT, ".json"),
     }
 
 
-def parse_document(xml_path: Path) -> Optional[Dict[str, Any]]:
-    """
-    Parse a single Lovdata 'XML' document (really HTML-ish) into a structured dict.
+# (title, metadata, sections, fallback full text) as extracted by a parser backend.
+# The fallback text is only filled in when no legal sections were found.
+Extracted = Tuple[str, Dict[str, Any], List[Dict[str, Any]], str]
 
-    We:
-    - Use lxml's HTML parser with recover=True (tolerant)
-    - Extract title
-    - Extract header metadata (dt/dd pairs)
-    - Extract legal sections with headings and paragraphs
-    - Build a canonical text body used for search
-    """
-    try:
-        tree = etree.parse(str(xml_path), HtmlParser)
-        root = tree.getroot()
-    except Exception as e:
-        print(
-            f"[lovdata2-mcp] Failed to parse {xml_path}: {e}",
-            file=sys.stderr,
-        )
-        return None
+
+def normalize_metadata_key(key: str) -> str:
+    """Normalize header keys: "Korttittel" -> "korttittel"."""
+    return re.sub(r"\s+", "_", key.strip().lower())
+
+
+def extract_with_selectolax(xml_path: str) -> Extracted:
+    """Extract title, metadata and sections using selectolax (lexbor backend)."""
+    with open(xml_path, "rb") as f:
+        tree = SelectolaxParser(f.read())
 
     # Title
-    title_el = root.find(".//title")
-    title = title_el.text.strip() if title_el is not None and title_el.text else "Untitled"
+    title_el = tree.css_first("title")
+    title = (title_el.text().strip() if title_el is not None else "") or "Untitled"
 
     # Metadata from <header class="documentHeader"> <dl>...
     metadata: Dict[str, Any] = {}
-    for dt in root.findall(".//header//dt"):
-        if dt.text is None:
-            continue
-        key = dt.text.strip()
+    for dt in tree.css("header dt"):
+        key = dt.text(deep=False).strip()
         if not key:
             continue
-        # Normalize key: "Korttittel" -> "korttittel"
-        norm_key = re.sub(r"\s+", "_", key.strip().lower())
-        dd = dt.getnext()
+        # Next element sibling, skipping text and comment nodes
+        dd = dt.next
+        while dd is not None and dd.tag.startswith(("-", "_")):
+            dd = dd.next
         if dd is not None:
-            value = " ".join(dd.itertext()).strip()
-            metadata[norm_key] = value
+            metadata[normalize_metadata_key(key)] = dd.text(separator=" ", strip=False).strip()
 
     # Sections
     sections: List[Dict[str, Any]] = []
-    for art in root.findall(".//article[@class='legalArticle']"):
-        heading_el = art.find(".//h2")
+    for art in tree.css('article[class="legalArticle"]'):
+        heading_el = art.css_first("h2")
         heading = (
-            " ".join(heading_el.itertext()).strip()
+            heading_el.text(separator=" ", strip=False).strip()
             if heading_el is not None
             else None
         )
 
         paragraphs: List[str] = [
-            " ".join(p.itertext()).strip()
-            for p in art.findall(".//article[@class='legalP']")
+            p.text(separator=" ", strip=False).strip()
+            for p in art.css('article[class="legalP"]')
         ]
         sections.append(
             {
@@ -155,6 +213,148 @@ def parse_document(xml_path: Path) -> Optional[Dict[str, Any]]:
             }
         )
 
+    full_text = ""
+    if not sections and tree.root is not None:
+        full_text = tree.root.text(separator="\n")
+
+    return title, metadata, sections, full_text
+
+
+# Compiled once instead of re-parsing the expression for every article.
+# The title and header are picked up from iterparse events, not by XPath.
+_XP_FIRST_H2 = etree.XPath("(.//h2)[1]")
+_XP_LEGAL_P = etree.XPath(".//article[@class='legalP']")
+
+
+def extract_with_lxml(xml_path: str) -> Extracted:
+    """
+    Extract title, metadata and sections using lxml's tolerant HTML parser.
+
+    The document is stream-parsed with iterparse: each legal article is
+    turned into a section as soon as it is complete and then cleared, so
+    only a small part of the tree is alive at any time.
+    """
+    context = etree.iterparse(
+        xml_path,
+        events=("start", "end"),
+        tag=("title", "header", "article"),
+        html=True,
+        recover=True,
+        encoding="utf-8",
+    )
+
+    title: Optional[str] = None
+    metadata: Dict[str, Any] = {}
+    sections: List[Dict[str, Any]] = []
+    # Indexes of the sections reserved for the currently open legal articles.
+    # A nested article ends before its parent, so the slot is taken when the
+    # article starts to keep sections in document order.
+    open_slots: List[int] = []
+
+    for event, elem in context:
+        tag = elem.tag
+
+        if event == "start":
+            if tag == "article" and elem.get("class") == "legalArticle":
+                open_slots.append(len(sections))
+                sections.append({})
+            continue
+
+        # Title (first <title> wins)
+        if tag == "title":
+            if title is None:
+                title = elem.text.strip() if elem.text else "Untitled"
+            continue
+
+        # Metadata from <header class="documentHeader"> <dl>...
+        if tag == "header":
+            for dt in elem.iter("dt"):
+                if dt.text is None:
+                    continue
+                key = dt.text.strip()
+                if not key:
+                    continue
+                dd = dt.getnext()
+                if dd is not None:
+                    value = " ".join(dd.itertext()).strip()
+                    metadata[normalize_metadata_key(key)] = value
+            continue
+
+        # Sections
+        if tag != "article" or elem.get("class") != "legalArticle":
+            continue
+
+        heading_els = _XP_FIRST_H2(elem)
+        heading = (
+            " ".join(heading_els[0].itertext()).strip()
+            if heading_els
+            else None
+        )
+
+        paragraphs: List[str] = [
+            " ".join(p.itertext()).strip()
+            for p in _XP_LEGAL_P(elem)
+        ]
+        sections[open_slots.pop()] = {
+            "heading": heading,
+            "paragraphs": [p for p in paragraphs if p],
+        }
+
+        # Drop the finished article and everything before it. Articles nested
+        # in another legal article are kept until their parent is processed.
+        nested = any(
+            a.get("class") == "legalArticle" for a in elem.iterancestors("article")
+        )
+        if not nested:
+            elem.clear(keep_tail=True)
+            parent = elem.getparent()
+            if parent is not None:
+                while elem.getprevious() is not None:
+                    del parent[0]
+
+    # Without sections nothing was cleared, so the full tree is still intact
+    full_text = "" if sections else "\n".join(context.root.itertext())
+
+    return title or "Untitled", metadata, sections, full_text
+
+
+def doc_id_from_path(xml_path: str) -> str:
+    """File name without extension, e.g. "sf-20061027-1196"."""
+    return os.path.splitext(os.path.basename(xml_path))[0]
+
+
+def parse_document(xml_path: str) -> Optional[Dict[str, Any]]:
+    """
+    Parse a single Lovdata 'XML' document (really HTML-ish) into a structured dict.
+
+    We:
+    - Parse with selectolax when installed (much faster), else lxml's
+      HTML parser with recover=True (tolerant); lxml is also the fallback
+      if selectolax fails on a document
+    - Extract title
+    - Extract header metadata (dt/dd pairs)
+    - Extract legal sections with headings and paragraphs
+    - Build a canonical text body used for search
+    """
+    extracted: Optional[Extracted] = None
+    if SelectolaxParser is not None:
+        try:
+            extracted = extract_with_selectolax(xml_path)
+        except Exception:
+            extracted = None
+
+    if extracted is None:
+        try:
+            extracted = extract_with_lxml(xml_path)
+        except Exception as e:
+            print(
+                f"[lovdata2-mcp] Failed to parse {xml_path}: {e}",
+                file=sys.stderr,
+            )
+            return None
+
+    title, metadata, sections, full_text = extracted
+
     # Canonical text body for search – prefer legal paragraphs, then full text
     if sections:
         body_parts: List[str] = []
@@ -164,14 +364,12 @@ def parse_document(xml_path: Path) -> Optional[Dict[str, Any]]:
             body_parts.extend(sec.get("paragraphs") or [])
         raw_text = "\n".join(body_parts)
     else:
-        raw_text = "\n".join(root.itertext())
+        raw_text = full_text
 
     raw_text = raw_text.strip()
-    raw_text_lower = raw_text.lower()
 
-    doc_id = xml_path.stem  # e.g. "sf-20061027-1196"
+    doc_id = doc_id_from_path(xml_path)
     kind = classify_doc_id(doc_id)
-    paths = compute_related_paths(xml_path)
 
     return {
         "id": doc_id,
@@ -180,39 +378,104 @@ def parse_document(xml_path: Path) -> Optional[Dict[str, Any]]:
         "metadata": metadata,
         "sections": sections,
         "raw_text": raw_text,
-        "raw_text_lower": raw_text_lower,
-        "paths": paths,
     }
 
 
-def load_corpus() -> Tuple[Dict[str, Dict[str, Any]], Dict[str, str]]:
+def load_document(xml_path: str) -> Optional[Dict[str, Any]]:
+    """
+    parse_document() with an on-disk msgpack cache.
+
+    A cached entry is used as long as it is at least as new as the XML file.
+    """
+    if msgpack is None:
+        return parse_document(xml_path)
+
+    cache_path = CACHE_DIR / (doc_id_from_path(xml_path) + ".msgpack")
+    try:
+        if cache_path.stat().st_mtime >= os.stat(xml_path).st_mtime:
+            return msgpack.unpackb(cache_path.read_bytes(), raw=False)
+    except Exception:
+        pass  # missing, stale or unreadable entry: parse again
+
+    doc = parse_document(xml_path)
+    if doc:
+        # Write a private temp file and rename it into place, so neither a
+        # concurrent reader nor an interrupted write leaves a truncated entry
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+        try:
+            tmp_path.write_bytes(msgpack.packb(doc))
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            # read-only data dir etc.; caching is best-effort
+            try:
+                tmp_path.unlink()
+            except OSError:
+                pass
+    return doc
+
+
+def iter_xml_files(root: str) -> Iterator[str]:
+    """
+    Yield the paths of all .xml files below root, as plain strings.
+
+    os.scandir reuses the file type from the directory listing, so unlike
+    Path.rglob this needs no extra stat() per entry, and plain strings are
+    cheaper than Path objects to create and to send to pool workers.
+    """
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".xml"):
+                    yield entry.path
+
+
+def load_corpus() -> Dict[str, Dict[str, Any]]:
     """Load and index all documents under XML_DIR."""
     corpus: Dict[str, Dict[str, Any]] = {}
-    search_index: Dict[str, str] = {}
 
     if not XML_DIR.exists():
         print(
             f"[lovdata2-mcp] WARNING: XML_DIR does not exist, corpus will be empty: {XML_DIR}",
             file=sys.stderr,
         )
-        return corpus, search_index
+        return corpus
 
-    xml_files = list(XML_DIR.rglob("*.xml"))
+    xml_files = list(iter_xml_files(str(XML_DIR)))
     print(
         f"[lovdata2-mcp] Scanning {len(xml_files)} XML files under {XML_DIR}",
         file=sys.stderr,
     )
 
-    parsed_count = 0
-    for xml_path in xml_files:
-        doc = parse_document(xml_path)
-        if not doc:
-            continue
+    if msgpack is not None:
+        try:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            print(f"[lovdata2-mcp] WARNING: parse cache disabled: {e}", file=sys.stderr)
 
-        doc_id = doc["id"]
-        corpus[doc_id] = doc
-        search_index[doc_id] = doc["raw_text_lower"]
-        parsed_count += 1
+    # Parsing is CPU-bound and independent per file, so spread it over all cores.
+    # Large chunks keep the pickling/IPC overhead per document small.
+    workers = os.cpu_count() or 1
+    chunksize = max(1, len(xml_files) // (workers * 4))
+
+    parsed_count = 0
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        docs = ex.map(load_document, xml_files, chunksize=chunksize)
+        for xml_path, doc in zip(xml_files, docs):
+            if not doc:
+                continue
+
+            # Resolved here rather than in the workers, so the output trees
+            # are listed once, and never come stale out of the parse cache
+            doc["paths"] = compute_related_paths(Path(xml_path))
+            # Kinds arrive as fresh strings from the workers / parse cache
+            doc["kind"] = sys.intern(doc["kind"])
+
+            doc_id = doc["id"]
+            corpus[doc_id] = doc
+            parsed_count += 1
 
     print(
         f"[lovdata2-mcp] Loaded {parsed_count} documents into corpus "
@@ -220,36 +483,372 @@ def load_corpus() -> Tuple[Dict[str, Dict[str, Any]], Dict[str, str]]:
         file=sys.stderr,
     )
 
-    return corpus, search_index
+    return corpus
+
+
+def build_inverted_index(
+    corpus: Dict[str, Dict[str, Any]],
+) -> Tuple[Dict[str, Dict[str, int]], Dict[str, int]]:
+    """
+    Build token -> {doc_id: term frequency} postings and per-document token counts.
+
+    Queries then only touch the postings of their own terms instead of
+    scanning the full text of every document.
+    """
+    inverted: Dict[str, Dict[str, int]] = {}
+    doc_len: Dict[str, int] = {}
+
+    for doc_id, doc in corpus.items():
+        tokens = tokenize(doc["raw_text"])
+        doc_len[doc_id] = len(tokens)
+        for tok in tokens:
+            postings = inverted.setdefault(tok, {})
+            postings[doc_id] = postings.get(doc_id, 0) + 1
+
+    print(
+        f"[lovdata2-mcp] Indexed {len(inverted)} unique tokens",
+        file=sys.stderr,
+    )
+
+    return inverted, doc_len
+
+
+# BM25 parameters: term frequency saturation and document length normalization
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def build_bm25_stats(
+    inverted: Dict[str, Dict[str, int]],
+    doc_len: Dict[str, int],
+) -> Tuple[Dict[str, float], float]:
+    """Compute per-term IDF and the average document length for BM25."""
+    n_docs = len(doc_len)
+    avg_doc_len = sum(doc_len.values()) / n_docs if n_docs else 0.0
+
+    idf: Dict[str, float] = {}
+    for term, postings in inverted.items():
+        df = len(postings)
+        idf[term] = math.log((n_docs - df + 0.5) / (df + 0.5) + 1)
+
+    return idf, avg_doc_len
+
+
+def bm25_weight(tf: int, idf: float, doc_len: int, avg_doc_len: float) -> float:
+    """BM25 contribution of one term occurring `tf` times in a document."""
+    length_norm = 1 - BM25_B + BM25_B * doc_len / avg_doc_len if avg_doc_len else 1.0
+    return idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * length_norm)
+
+
+def build_term_matrix(
+    corpus: Dict[str, Dict[str, Any]],
+    inverted: Dict[str, Dict[str, int]],
+    doc_len: Dict[str, int],
+    idf: Dict[str, float],
+    avg_doc_len: float,
+) -> Tuple[Any, Dict[str, int], List[str], Any, Any]:
+    """
+    Pack BM25 weights into a sparse term x document matrix for vectorized scoring.
+
+    BM25 weights do not depend on the query, so they are computed once here
+    and a query score is just the sum of its term rows.
+
+    Returns (matrix, term_rows, doc_ids, doc_kinds, doc_title_rank):
+    - matrix:         scipy CSR matrix of BM25 weights, rows = terms,
+                      columns = document index
+    - term_rows:      token -> matrix row
+    - doc_ids:        document index -> doc id
+    - doc_kinds:      document index -> kind (numpy array, for kind filtering)
+    - doc_title_rank: document index -> position when sorted by (title, id),
+                      used to break score ties without a Python-level sort
+
+    Without NumPy/SciPy the matrix is None and search uses the dict postings.
+    """
+    if np is None or sparse is None:
+        return None, {}, [], None, None
+
+    doc_ids = list(corpus)
+    doc_index = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+
+    term_rows: Dict[str, int] = {}
+    indptr: List[int] = [0]
+    indices: List[int] = []
+    data: List[float] = []
+    for term, postings in inverted.items():
+        term_rows[term] = len(term_rows)
+        term_idf = idf[term]
+        for doc_id, tf in postings.items():
+            indices.append(doc_index[doc_id])
+            data.append(bm25_weight(tf, term_idf, doc_len[doc_id], avg_doc_len))
+        indptr.append(len(indices))
+
+    matrix = sparse.csr_matrix(
+        (
+            np.asarray(data, dtype=np.float64),
+            np.asarray(indices, dtype=np.int32),
+            np.asarray(indptr, dtype=np.int64),
+        ),
+        shape=(len(term_rows), len(doc_ids)),
+    )
+
+    doc_kinds = np.asarray([corpus[doc_id]["kind"] for doc_id in doc_ids])
+
+    by_title = sorted(range(len(doc_ids)), key=lambda i: (corpus[doc_ids[i]]["title"], doc_ids[i]))
+    doc_title_rank = np.empty(len(doc_ids), dtype=np.int64)
+    doc_title_rank[by_title] = np.arange(len(doc_ids))
+
+    return matrix, term_rows, doc_ids, doc_kinds, doc_title_rank
+
+
+def build_doc_lists(
+    corpus: Mapping[str, Dict[str, Any]],
+) -> Tuple[List[Dict[str, Any]], Dict[str, List[Dict[str, Any]]]]:
+    """
+    Precompute the light list_documents entries, sorted by title.
+
+    Returns (all entries, entries per kind), so paging is a list slice
+    instead of rebuilding an entry for every document on each call.
+    """
+    entries = sorted(
+        (
+            {
+                "id": doc_id,
+                "kind": doc["kind"],
+                "title": doc["title"],
+                "korttittel": doc["metadata"].get("korttittel"),
+                "datokode": doc["metadata"].get("datokode"),
+            }
+            for doc_id, doc in corpus.items()
+        ),
+        key=lambda entry: (entry["title"], entry["id"]),
+    )
+
+    by_kind: Dict[str, List[Dict[str, Any]]] = {}
+    for entry in entries:
+        by_kind.setdefault(entry["kind"], []).append(entry)
+
+    return entries, by_kind
+
+
+def loads_json(raw: bytes) -> Any:
+    """Decode UTF-8 JSON bytes, with orjson when available."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _attach_segment(name: str) -> shared_memory.SharedMemory:
+    """Attach to an existing segment without taking over its cleanup."""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        # Older Pythons register every attached segment with the resource
+        # tracker, which would remove it when this process exits
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class CorpusView(Mapping[str, Dict[str, Any]]):
+    """
+    Read-only doc_id -> document mapping backed by one shared memory segment.
+
+    Every document is stored as a JSON blob in the segment, after a JSON
+    index of doc_id -> (offset, length); documents are decoded on access.
+    The creating server logs the segment name, and other server instances
+    started with LOVDATA2_SHARED_CORPUS_ATTACH=<name> map the same pages
+    instead of loading their own copy. The segment is removed when the
+    creating process exits; already attached processes keep their mapping.
+
+    Layout: 8-byte little-endian index length, index JSON, document blobs.
+    """
+
+    def __init__(
+        self,
+        shm: shared_memory.SharedMemory,
+        offsets: Dict[str, Tuple[int, int]],
+        owner: bool,
+    ):
+        self._shm: Optional[shared_memory.SharedMemory] = shm
+        self._offsets = offsets
+        self._owner_pid = os.getpid() if owner else None
+        atexit.register(self.close)
+
+    @classmethod
+    def create(cls, corpus: Dict[str, Dict[str, Any]]) -> "CorpusView":
+        """
+        Move `corpus` into a new segment. The dict is emptied as documents
+        are copied, and each document is encoded on its own, so the peak is
+        about one copy of the corpus rather than dicts + blobs + segment.
+        """
+        def encode(doc: Dict[str, Any]) -> bytes:
+            return json.dumps(doc, ensure_ascii=False).encode("utf-8")
+
+        # First pass only measures: the segment size has to be known up front
+        offsets: Dict[str, Tuple[int, int]] = {}
+        pos = 0
+        for doc_id, doc in corpus.items():
+            length = len(encode(doc))
+            offsets[doc_id] = (pos, length)
+            pos += length
+
+        index = json.dumps(offsets).encode("utf-8")
+        base = 8 + len(index)
+        shm = shared_memory.SharedMemory(create=True, size=base + pos)
+        shm.buf[:8] = len(index).to_bytes(8, "little")
+        shm.buf[8:base] = index
+
+        # Second pass writes; segment pages are only allocated when touched,
+        # so memory moves from the dicts to the segment document by document
+        for doc_id in list(corpus):
+            blob = encode(corpus.pop(doc_id))
+            offset, length = offsets[doc_id]
+            shm.buf[base + offset : base + offset + length] = blob
+
+        return cls(shm, {k: (base + o, n) for k, (o, n) in offsets.items()}, owner=True)
+
+    @classmethod
+    def attach(cls, name: str) -> "CorpusView":
+        """Open a segment created by another server's CorpusView.create."""
+        shm = _attach_segment(name)
+        index_len = int.from_bytes(shm.buf[:8], "little")
+        base = 8 + index_len
+        offsets = loads_json(bytes(shm.buf[8:base]))
+        return cls(shm, {k: (base + o, n) for k, (o, n) in offsets.items()}, owner=False)
+
+    def __getitem__(self, doc_id: str) -> Dict[str, Any]:
+        offset, length = self._offsets[doc_id]
+        return loads_json(bytes(self._shm.buf[offset : offset + length]))
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._offsets)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __contains__(self, doc_id: object) -> bool:
+        return doc_id in self._offsets
+
+    @property
+    def shm_name(self) -> str:
+        return self._shm.name
+
+    def close(self) -> None:
+        """Release the segment; only the creating process removes it."""
+        if self._shm is None:
+            return
+        self._shm.close()
+        if os.getpid() == self._owner_pid:
+            self._shm.unlink()
+        self._shm = None
+
+
+CORPUS: Mapping[str, Dict[str, Any]] = {}
+INVERTED: Dict[str, Dict[str, int]] = {}
+DOC_LEN: Dict[str, int] = {}
+IDF: Dict[str, float] = {}
+AVG_DOC_LEN = 0.0
+TERM_MATRIX: Any = None
+TERM_ROWS: Dict[str, int] = {}
+DOC_IDS: List[str] = []
+DOC_KINDS: Any = None
+DOC_TITLE_RANK: Any = None
+DOC_TITLES: Dict[str, str] = {}
+DOC_LIST_ALL: List[Dict[str, Any]] = []
+DOC_LIST_BY_KIND: Dict[str, List[Dict[str, Any]]] = {}
+DOC_IDS_BY_KIND: Dict[str, FrozenSet[str]] = {}
+
+
+def init_corpus() -> None:
+    """
+    Load the corpus and build the search indexes into the module globals.
+
+    Called from the entry point rather than at import time, so that the
+    worker processes used by load_corpus can import this module without
+    recursively loading the corpus themselves.
+    """
+    global CORPUS, INVERTED, DOC_LEN, IDF, AVG_DOC_LEN
+    global TERM_MATRIX, TERM_ROWS, DOC_IDS, DOC_KINDS, DOC_TITLE_RANK, DOC_TITLES
+    global DOC_LIST_ALL, DOC_LIST_BY_KIND, DOC_IDS_BY_KIND
+    if SHARED_CORPUS_ATTACH:
+        CORPUS = CorpusView.attach(SHARED_CORPUS_ATTACH)
+        print(
+            f"[lovdata2-mcp] Attached to shared corpus segment {SHARED_CORPUS_ATTACH} "
+            f"({len(CORPUS)} documents)",
+            file=sys.stderr,
+        )
+    else:
+        CORPUS = load_corpus()
+    INVERTED, DOC_LEN = build_inverted_index(CORPUS)
+    IDF, AVG_DOC_LEN = build_bm25_stats(INVERTED, DOC_LEN)
+    TERM_MATRIX, TERM_ROWS, DOC_IDS, DOC_KINDS, DOC_TITLE_RANK = build_term_matrix(
+        CORPUS, INVERTED, DOC_LEN, IDF, AVG_DOC_LEN
+    )
+    DOC_LIST_ALL, DOC_LIST_BY_KIND = build_doc_lists(CORPUS)
+    DOC_IDS_BY_KIND = {
+        kind: frozenset(entry["id"] for entry in entries)
+        for kind, entries in DOC_LIST_BY_KIND.items()
+    }
+
+    # The rankers need every candidate's title; keep them outside CORPUS, so
+    # ranking doesn't decode whole documents from a CorpusView
+    DOC_TITLES = {doc_id: doc["title"] for doc_id, doc in CORPUS.items()}
 
+    if SHARED_CORPUS and CORPUS and not isinstance(CORPUS, CorpusView):
+        CORPUS = CorpusView.create(CORPUS)
+        print(
+            f"[lovdata2-mcp] Corpus moved to shared memory segment {CORPUS.shm_name}; "
+            f"set LOVDATA2_SHARED_CORPUS_ATTACH={CORPUS.shm_name} to share it",
+            file=sys.stderr,
+        )
 
-CORPUS, SEARCH_INDEX = load_corpus()
 
 # =============================================================================
 # SEARCH
 # =============================================================================
 
-def score_document(text_lower: str, query_terms: List[str]) -> int:
+def score_document(doc_id: str, query_terms: Sequence[str]) -> float:
     """
-    Very simple scoring: sum of term frequencies for all query terms.
+    BM25 score of a document: sum of the BM25 weights of all query terms.
     """
-    score = 0
+    score = 0.0
     for term in query_terms:
-        if not term:
+        tf = INVERTED.get(term, {}).get(doc_id, 0)
+        if not tf:
             continue
-        score += text_lower.count(term)
+        score += bm25_weight(tf, IDF[term], DOC_LEN[doc_id], AVG_DOC_LEN)
     return score
 
 
-def extract_snippet(text_lower: str, original_text: str, query_term: str, radius: int = 120) -> str:
+@functools.lru_cache(maxsize=4096)
+def build_snippet_pattern(query_terms: Tuple[str, ...]) -> re.Pattern[str]:
+    """
+    Compile one case-insensitive alternation of all query terms.
+
+    Searching the original text with it finds the first occurrence of any
+    term in a single pass, without a lowercased copy of the document, and
+    yields offsets that are valid in the original text.
     """
-    Extract a small snippet around the first match of `query_term` in `text_lower`.
-    Falls back to the beginning if term is not found.
+    # Longest first, so a term never shadows a longer one at the same position
+    unique_terms = sorted({t for t in query_terms if t}, key=len, reverse=True)
+    return re.compile("|".join(map(re.escape, unique_terms)), re.IGNORECASE)
+
+
+def extract_snippet(
+    original_text: str,
+    pattern: re.Pattern[str],
+    radius: int = 120,
+) -> str:
     """
-    idx = text_lower.find(query_term)
-    if idx == -1:
+    Extract a small snippet around the first match of `pattern` in `original_text`.
+    Falls back to the beginning if no term is found.
+    """
+    match = pattern.search(original_text)
+    if match is None:
         return original_text[: radius * 2] + ("..." if len(original_text) > radius * 2 else "")
 
+    idx = match.start()
+
     start = max(0, idx - radius)
     end = min(len(original_text), idx + radius)
     snippet = original_text[start:end].strip()
@@ -260,58 +859,101 @@ def extract_snippet(text_lower: str, original_text: str, query_term: str, radius
     return snippet
 
 
+def rank_with_postings(
+    terms: Sequence[str],
+    kind: Optional[str],
+    limit: int,
+) -> List[Tuple[float, str, str]]:
+    """Return the top (score, title, doc_id) hits, scored from the dict postings."""
+    # Only documents that contain at least one query token can score
+    candidates = set().union(*(INVERTED.get(t, {}).keys() for t in terms))
+    if kind:
+        # One set intersection instead of looking up every candidate's kind
+        candidates &= DOC_IDS_BY_KIND.get(kind, frozenset())
+
+    def scored() -> Iterator[Tuple[float, str, str]]:
+        for doc_id in candidates:
+            score = score_document(doc_id, terms)
+            if score <= 0:
+                continue
+
+            yield score, DOC_TITLES[doc_id], doc_id
+
+    # Sort by score desc, then title; a bounded heap keeps only the top `limit`
+    return heapq.nsmallest(limit, scored(), key=lambda tup: (-tup[0], tup[1], tup[2]))
+
+
+def rank_with_matrix(
+    terms: Sequence[str],
+    kind: Optional[str],
+    limit: int,
+) -> List[Tuple[float, str, str]]:
+    """Return the top (score, title, doc_id) hits, scored from TERM_MATRIX."""
+    rows = [TERM_ROWS[t] for t in terms if t in TERM_ROWS]
+    if not rows:
+        return []
+
+    scores = np.asarray(TERM_MATRIX[rows].sum(axis=0)).ravel()
+    if kind:
+        scores = np.where(DOC_KINDS == kind, scores, 0)
+
+    hits = np.flatnonzero(scores > 0)
+    if len(hits) > limit:
+        # Keep only hits scoring at least the limit-th best score (ties
+        # included), so the full ordering below only sees O(limit) entries
+        cutoff = len(hits) - limit
+        threshold = np.partition(scores[hits], cutoff)[cutoff]
+        hits = hits[scores[hits] >= threshold]
+
+    # Sort by score desc, then title (lexsort uses the last key as primary)
+    top = hits[np.lexsort((DOC_TITLE_RANK[hits], -scores[hits]))[:limit]]
+
+    return [
+        (float(scores[i]), DOC_TITLES[DOC_IDS[i]], DOC_IDS[i])
+        for i in top
+    ]
+
+
 def search_documents(
     query: str,
     kind: Optional[str] = None,
     limit: int = 20,
 ) -> List[Dict[str, Any]]:
     """
-    Search in CORPUS using a very simple term-frequency scoring.
+    Search in CORPUS using BM25 scoring.
     """
     q = query.strip()
     if not q:
         return []
 
-    terms = tokenize(q)
+    terms = tokenize_query(q)
     if not terms:
         return []
 
-    results: List[Tuple[int, Dict[str, Any]]] = []
-    for doc_id, doc in CORPUS.items():
-        if kind and doc["kind"] != kind:
-            continue
+    pattern = build_snippet_pattern(terms)
 
-        text_lower = SEARCH_INDEX.get(doc_id, "")
-        if not text_lower:
-            continue
-
-        score = score_document(text_lower, terms)
-        if score <= 0:
-            continue
+    limit = max(1, min(limit, 100))
+    if TERM_MATRIX is not None:
+        ranked = rank_with_matrix(terms, kind, limit)
+    else:
+        ranked = rank_with_postings(terms, kind, limit)
 
-        # Use the first term for snippet extraction
-        snippet = extract_snippet(
-            text_lower=text_lower,
-            original_text=doc["raw_text"],
-            query_term=terms[0],
-        )
+    results: List[Dict[str, Any]] = []
+    for score, title, doc_id in ranked:
+        doc = CORPUS[doc_id]
+        snippet = extract_snippet(original_text=doc["raw_text"], pattern=pattern)
 
         results.append(
-            (
-                score,
-                {
-                    "id": doc_id,
-                    "kind": doc["kind"],
-                    "title": doc["title"],
-                    "score": score,
-                    "snippet": snippet,
-                },
-            )
+            {
+                "id": doc_id,
+                "kind": doc["kind"],
+                "title": title,
+                "score": round(score, 4),
+                "snippet": snippet,
+            }
         )
 
-    # Sort by score desc, then title
-    results.sort(key=lambda tup: (-tup[0], tup[1]["title"]))
-    return [r for _, r in results[: max(1, min(limit, 100))]]
+    return results
 
 
 # =============================================================================
@@ -390,17 +1032,7 @@ def list_documents(
     limit = max(1, min(limit, 200))
     offset = max(0, offset)
 
-    docs = [
-        {
-            "id": doc_id,
-            "kind": doc["kind"],
-            "title": doc["title"],
-            "korttittel": doc["metadata"].get("korttittel"),
-            "datokode": doc["metadata"].get("datokode"),
-        }
-        for doc_id, doc in CORPUS.items()
-        if not kind or doc["kind"] == kind
-    ]
+    docs = DOC_LIST_BY_KIND.get(kind, []) if kind else DOC_LIST_ALL
 
     total = len(docs)
     sliced = docs[offset : offset + limit]
@@ -426,9 +1058,7 @@ def get_document(doc_id: str) -> Dict[str, Any]:
             "message": f"Document '{doc_id}' not found in corpus.",
         }
 
-    # Copy but drop the lowercase index field, which is internal
-    doc_public = {k: v for k, v in doc.items() if k != "raw_text_lower"}
-    return doc_public
+    return doc
 
 
 @mcp.tool()
@@ -511,10 +1141,7 @@ def get_raw_view(doc_id: str, fmt: str = "xml") -> Dict[str, Any]:
         }
 
     if fmt == "json":
-        import json
-
-        with path.open("r", encoding="utf-8") as f:
-            data = json.load(f)
+        data = loads_json(path.read_bytes())
         return {
             "doc_id": doc_id,
             "format": fmt,
@@ -523,8 +1150,7 @@ def get_raw_view(doc_id: str, fmt: str = "xml") -> Dict[str, Any]:
         }
 
     # All other formats: treat as text
-    with path.open("r", encoding="utf-8") as f:
-        text = f.read()
+    text = path.read_bytes().decode("utf-8")
 
     return {
         "doc_id": doc_id,
@@ -539,5 +1165,6 @@ def get_raw_view(doc_id: str, fmt: str = "xml") -> Dict[str, Any]:
 # =============================================================================
 
 if __name__ == "__main__":
+    init_corpus()
     # Runs an MCP stdio server; Claude/Cursor will spawn this as a subprocess.
     mcp.run()
\ No newline at end of file
@@ -10,16 +10,40 @@ Now includes:
     ✔ Rich progress bar
     ✔ Graceful Ctrl-C handling
     ✔ Minimal console output
+    ✔ Parallel processing on all CPU cores
 """
 
+import argparse
+import codecs
+import functools
+import io
+import mmap
+import os
+import re
+import shutil
+import signal
+import subprocess
 import tarfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from html import escape
 from pathlib import Path
-from textwrap import fill
+from textwrap import TextWrapper
 
-import chardet
 from lxml import etree, html
 from rich.progress import Progress, TimeElapsedColumn, TimeRemainingColumn, BarColumn, TextColumn
 
+try:
+    from cchardet import detect  # C implementation, much faster
+except ImportError:
+    from chardet import detect
+
+try:
+    import indexed_bzip2  # parallel bzip2 decompression
+except ImportError:
+    indexed_bzip2 = None
+
 BASE_DIR = Path(__file__).resolve().parents[1]
 
 RAW_DIR = BASE_DIR / "raw"
@@ -33,46 +57,472 @@ MD_DIR = DATA_DIR / "markdown"
 
 WRAP_WIDTH = 100
 
+# Shared by every paragraph, instead of building a wrapper per fill() call
+_WRAPPER = TextWrapper(width=WRAP_WIDTH)
+
+# Runs of whitespace, collapsed to one space in C rather than split()/join()
+_WS = re.compile(r"\s+")
+
+# encoding="..." in an XML declaration, or charset=... in a <meta> tag
+DECLARED_ENCODING_RE = re.compile(
+    rb"""(?:encoding|charset)\s*=\s*["']?([A-Za-z0-9._:-]+)""", re.IGNORECASE
+)
+
 
 def detect_encoding(raw: bytes) -> str:
-    guess = chardet.detect(raw)
-    enc = guess.get("encoding") or "utf-8"
+    # A declared encoding (XML prolog or <meta charset>) sits at the very top;
+    # only fall back to statistical detection, on a bounded prefix, without one
+    enc = None
+    declared = DECLARED_ENCODING_RE.search(raw[:1024])
+    if declared:
+        enc = declared.group(1).decode("ascii")
+        try:
+            codecs.lookup(enc)
+        except LookupError:
+            enc = None
+
+    if enc is None:
+        sample = raw[:65536]
+        try:
+            # Lovdata is overwhelmingly UTF-8: accept it with one pass of the
+            # C decoder before paying for statistical detection. Not final,
+            # so a character cut off by the sample boundary still passes.
+            codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+            enc = "utf-8"
+        except UnicodeDecodeError:
+            guess = detect(sample)
+            enc = guess.get("encoding") or "utf-8"
+
     if enc.lower() in ("latin-1", "iso-8859-1"):
         return "iso-8859-1"
+    # libxml2 doesn't know Python's BOM-stripping alias, and skips a BOM itself
+    if enc.lower() == "utf-8-sig":
+        return "utf-8"
     return enc
 
 
+# Equivalent of lxml.html's text_content(), but also works on plain etree
+# elements (XML fallback parser, iterparse)
+_TEXT_CONTENT = etree.XPath("string()", smart_strings=False)
+
+
+# <dd> classes holding the document title (alongside <h1>)
+TITLE_CLASSES = ("title", "titleShort")
+
+
+def is_title_element(el) -> bool:
+    """True for <dd class="title|titleShort"> and <h1>."""
+    return el.tag == "h1" or (el.tag == "dd" and el.get("class") in TITLE_CLASSES)
+
+
+def find_title(root):
+    """
+    First <dd class="title|titleShort"> or <h1> in document order, or None.
+
+    A single walk that stops at the first hit, instead of an XPath union
+    that collects every match.
+    """
+    for el in root.iter("dd", "h1"):
+        if is_title_element(el):
+            return el
+    return None
+
+# Reused for every document. We only ever look at tags, classes and text, so
+# skip comments, processing instructions and the id index; huge_tree lifts
+# libxml2's limits for the largest laws.
+_PARSER_OPTIONS = dict(remove_comments=True, remove_pis=True, collect_ids=False, huge_tree=True)
+_XML_PARSER = etree.XMLParser(recover=True, **_PARSER_OPTIONS)
+
+
+@functools.lru_cache(maxsize=None)
+def _html_parser(enc: str):
+    """HTML parser decoding bytes as `enc` itself, one per encoding seen."""
+    return html.HTMLParser(encoding=enc, **_PARSER_OPTIONS)
+
+
+# An XML declaration naming the encoding, at the very start of the file
+# (the check lxml does before refusing such documents as text)
+XML_ENCODING_DECL_RE = re.compile(rb"<\?xml[^>]+\s+encoding\s*=")
+
+# What lxml.html.fromstring() takes for a whole document rather than a fragment
+FULL_HTML_RE = re.compile(rb"\s*<(?:html|!doctype)", re.IGNORECASE)
+
+# Whitespace inside these is significant (or not prose) and is left alone
+PRESERVE_TEXT_TAGS = ("script", "style", "pre", "textarea")
+
+
 def wrap_text_nodes(element, width=WRAP_WIDTH):
     """Wrap long text nodes."""
-    if element.text and element.text.strip():
-        element.text = fill(" ".join(element.text.split()), width=width)
+    preserved_roots = set(element.iter(*PRESERVE_TEXT_TAGS))
+    preserved_inner = {
+        child
+        for root in preserved_roots
+        for child in root.iter()
+        if child is not root
+    }
+
+    wrap = TextWrapper(width=width).fill
+
+    for el in element.iter():
+        if el in preserved_inner:
+            continue
+
+        text = el.text
+        if text and not text.isspace() and el not in preserved_roots:
+            el.text = wrap(_WS.sub(" ", text).strip())
+
+        tail = el.tail
+        if tail and not tail.isspace():
+            el.tail = wrap(_WS.sub(" ", tail).strip())
+
+
+@contextmanager
+def open_tarball(tar_path: Path):
+    """
+    Open a .tar.bz2 for streaming extraction.
+
+    bzip2 decompression is the bottleneck here, so prefer decompressing on
+    all cores: indexed_bzip2 if installed, else an external pbzip2. The
+    stdlib's single-threaded bz2 is the fallback.
+    """
+    if indexed_bzip2 is not None:
+        with indexed_bzip2.open(str(tar_path), parallelization=os.cpu_count()) as raw:
+            with tarfile.open(fileobj=raw, mode="r|") as tf:
+                yield tf
+        return
+
+    pbzip2 = shutil.which("pbzip2")
+    if pbzip2:
+        proc = subprocess.Popen([pbzip2, "-dc", str(tar_path)], stdout=subprocess.PIPE)
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode="r|") as tf:
+                yield tf
+        finally:
+            proc.stdout.close()
+            proc.wait()
+        if proc.returncode != 0:
+            raise RuntimeError(f"pbzip2 failed on {tar_path} (exit code {proc.returncode})")
+        return
+
+    with tarfile.open(tar_path, "r:bz2") as tf:
+        yield tf
+
 
-    if element.tail and element.tail.strip():
-        element.tail = fill(" ".join(element.tail.split()), width=width)
+# Member writes run on threads (file I/O releases the GIL); more than a handful
+# of writers only thrashes the disk queue
+EXTRACT_WRITERS = min(8, os.cpu_count() or 1)
 
-    for child in element:
-        wrap_text_nodes(child, width=width)
+# Upper bound on decompressed members held in memory waiting to be written
+EXTRACT_MAX_PENDING = 64
+
+
+def _member_target(subdir: Path, subdir_real: str, member: tarfile.TarInfo):
+    """
+    Sanitize a tar member and return it with its destination path.
+
+    Uses the stdlib "data" filter where available (Python 3.11.4+), which
+    rejects absolute paths, links out of the target and device files, and
+    clears unsafe mode bits. Otherwise only refuse paths escaping subdir,
+    whose realpath the caller resolves once as `subdir_real`.
+    """
+    if hasattr(tarfile, "data_filter"):
+        member = tarfile.data_filter(member, subdir_real)
+        return member, subdir / member.name
+
+    target = subdir / member.name
+    # commonpath, not a prefix test, so a "./" member (subdir itself) passes
+    if os.path.commonpath([subdir_real, os.path.realpath(target)]) != subdir_real:
+        raise tarfile.TarError(f"Refusing to extract outside {subdir}: {member.name}")
+    return member, target
+
+
+def _write_member(target: Path, data: bytes, mode, mtime):
+    """Write one regular file extracted from a tarball; its directory exists."""
+    with open(target, "wb") as f:
+        f.write(data)
+    if mode is not None:
+        os.chmod(target, mode)
+    if mtime is not None:
+        os.utime(target, (mtime, mtime))
 
 
 def extract_tarballs():
     """Extract the public Lovdata tarballs into raw/xml_original."""
     XML_ORIG_DIR.mkdir(parents=True, exist_ok=True)
 
+    # The "data" filter rejects unsafe members (absolute paths, links out of
+    # the target, device files); available from Python 3.11.4
+    extract_kwargs = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+
     for tar_path in TARBALL_DIR.glob("*.tar.bz2"):
         print(f"Extracting: {tar_path.name}")
 
-        with tarfile.open(tar_path, "r:bz2") as tf:
+        with open_tarball(tar_path) as tf, ThreadPoolExecutor(EXTRACT_WRITERS) as pool:
             subdir = XML_ORIG_DIR / tar_path.stem
             subdir.mkdir(parents=True, exist_ok=True)
-            tf.extractall(subdir)
+            subdir_real = os.path.realpath(subdir)
+
+            # Decompression has to be sequential, but the writes don't:
+            # read each member here and hand the bytes to a writer thread
+            pending = deque()
+            # Directories created so far, so members sharing a directory
+            # don't each pay for a mkdir (thousands of files per directory)
+            made_dirs = {subdir}
+            # Directory modes and mtimes are applied last, as extractall does:
+            # writing into a directory bumps its mtime, and a read-only mode
+            # would block the writes
+            dir_members = []
+            try:
+                for member in tf:
+                    member, target = _member_target(subdir, subdir_real, member)
+
+                    if member.isdir():
+                        if target not in made_dirs:
+                            target.mkdir(parents=True, exist_ok=True)
+                            made_dirs.add(target)
+                        dir_members.append((target, member))
+                        continue
+                    if not member.isfile():
+                        # Links etc. are rare; let tarfile handle them in
+                        # order, once the files they may point to are written
+                        while pending:
+                            pending.popleft().result()
+                        tf.extract(member, subdir, **extract_kwargs)
+                        continue
+
+                    if target.parent not in made_dirs:
+                        target.parent.mkdir(parents=True, exist_ok=True)
+                        made_dirs.add(target.parent)
+
+                    data = tf.extractfile(member).read()
+                    pending.append(pool.submit(_write_member, target, data, member.mode, member.mtime))
+                    while len(pending) > EXTRACT_MAX_PENDING:
+                        pending.popleft().result()
+
+                for future in pending:
+                    future.result()
+
+                # Deepest first, so setting a parent doesn't disturb a child
+                for target, member in sorted(dir_members, key=lambda d: d[1].name, reverse=True):
+                    if member.mode is not None:
+                        os.chmod(target, member.mode)
+                    if member.mtime is not None:
+                        os.utime(target, (member.mtime, member.mtime))
+            except KeyboardInterrupt:
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+
+
+@contextmanager
+def map_input(path: Path):
+    """
+    Memory-map an input file read-only, so the parsers and the encoding
+    sniffing read straight from the page cache instead of a bytes copy.
+    Empty files can't be mapped and are yielded as b"".
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # Each file is read front to back exactly once
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            yield mm
+
+
+def extract_title_and_body(raw, enc: str):
+    """
+    Stream-parse a document for just its title and <main> text.
+
+    Uses iterparse and prunes already-handled <header>s outside <main>, so
+    the full tree is never kept around for pretty-printing. Returns
+    (title, body_text), where title may be None, or None when the document
+    has no <main>.
+    """
+    title = None
+    body_text = None
+
+    # An mmap is already a file-like object, no need to copy it into BytesIO
+    context = etree.iterparse(
+        raw if isinstance(raw, mmap.mmap) else io.BytesIO(raw),
+        events=("end",),
+        tag=("header", "dd", "h1", "main"),
+        html=True,
+        recover=True,
+        encoding=enc,
+        **_PARSER_OPTIONS,
+    )
+    for _, elem in context:
+        if elem.tag == "main":
+            body_text = _TEXT_CONTENT(elem).strip()
+            if title is not None:
+                break
+        elif title is None and is_title_element(elem):
+            title = _TEXT_CONTENT(elem).strip()
+        elif elem.tag == "header" and next(elem.iterancestors("main"), None) is None:
+            # Title candidates inside the header have been seen already.
+            # Headers within <main> (chapter headings) are body text, keep them.
+            elem.clear(keep_tail=True)
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+    if body_text is None:
+        return None
+    return title, body_text
+
+
+def _write_lines(path: Path, lines) -> None:
+    """
+    Write lines joined by newlines, as "\n".join() would, through a large
+    buffer instead of building the whole document as one string first.
+    """
+    with open(path, "wb", buffering=1 << 20) as f:
+        first = True
+        for line in lines:
+            if not first:
+                f.write(b"\n")
+            f.write(line.encode("utf-8"))
+            first = False
+
+
+def _iter_html(title: str, paragraphs):
+    title = escape(title)
+    yield "<!DOCTYPE html>"
+    yield '<html lang="no">'
+    yield "<head>"
+    yield '<meta charset="utf-8">'
+    yield f"<title>{title}</title>"
+    yield "<style>body{font-family:sans-serif;max-width:700px;margin:2rem auto;}p{margin-bottom:1rem;}</style>"
+    yield "</head>"
+    yield "<body>"
+    yield f"<h1>{title}</h1>"
+    for p in paragraphs:
+        yield f"<p>{escape(p)}</p>"
+    yield "</body></html>"
+
+
+def _iter_md(title: str, paragraphs):
+    yield f"# {title}"
+    yield ""
+    for p in paragraphs:
+        yield f"{p}\n"
+
+
+def write_derived(title: str, body_text: str, html_path: Path, md_path: Path) -> None:
+    """Write the simple HTML and Markdown versions of a document."""
+    paragraphs = [
+        _WRAPPER.fill(_WS.sub(" ", p).strip())
+        for p in body_text.split("\n")
+        if p and not p.isspace()
+    ]
+
+    _write_lines(html_path, _iter_html(title, paragraphs))
+    _write_lines(md_path, _iter_md(title, paragraphs))
+
+
+def process_one(xml_file: Path, pretty: bool = True) -> None:
+    """
+    Write the HTML and Markdown versions of one XML file, and its
+    pretty-printed copy unless `pretty` is False.
+
+    Runs in a worker process. lxml's errors carry an unpicklable error log,
+    so failures are re-raised as a plain RuntimeError naming the file.
+    """
+    try:
+        _process_one(xml_file, pretty)
+    except Exception as e:
+        raise RuntimeError(f"{xml_file}: {type(e).__name__}: {e}") from None
+
+
+def _process_one(xml_file: Path, pretty: bool) -> None:
+    rel = xml_file.relative_to(XML_ORIG_DIR)
+
+    pretty_path = XML_PRETTY_DIR / rel
+    html_path = HTML_DIR / rel.with_suffix(".html")
+    md_path = MD_DIR / rel.with_suffix(".md")
+
+    with map_input(xml_file) as raw:
+        enc = detect_encoding(raw)
+
+        # Documents declaring their encoding in an XML prolog are XML
+        is_html = not XML_ENCODING_DECL_RE.match(raw)
+
+        # Without pretty output the full tree is not needed: stream the two
+        # things we use. Documents without <main>, and XML documents (which
+        # the streaming HTML parse would read differently), take the full
+        # path below.
+        if not pretty and is_html:
+            extracted = extract_title_and_body(raw, enc)
+            if extracted is not None:
+                title, body_text = extracted
+                write_derived(title or rel.stem, body_text, html_path, md_path)
+                return
+
+        # Parse with fallback. libxml2 decodes the bytes itself, so no decoded
+        # copy of the document is built in Python.
+        if is_html:
+            try:
+                # Whole documents are parsed straight from the map. Only
+                # fragments need fromstring()'s unwrapping, and it only sniffs
+                # bytes or str (without a BOM), so those pay for a copy.
+                start = len(codecs.BOM_UTF8) if raw[:3] == codecs.BOM_UTF8 else 0
+                if FULL_HTML_RE.match(raw, start):
+                    doc = html.document_fromstring(raw, parser=_html_parser(enc))
+                else:
+                    doc = html.fromstring(raw[start:], parser=_html_parser(enc))
+            except Exception:
+                is_html = False
+        if not is_html:
+            doc = etree.fromstring(raw, parser=_XML_PARSER)
+
+    # Generate simple HTML + Markdown. Read the text before wrapping, so the
+    # line breaks inserted for the pretty copy don't split paragraphs.
+    root = doc.getroottree().getroot()
+    title_el = find_title(root)
+    title = (_TEXT_CONTENT(title_el).strip() if title_el is not None else "") or rel.stem
+
+    body_el = next(root.iter("main"), None)
+    body_text = _TEXT_CONTENT(body_el if body_el is not None else doc).strip()
+
+    write_derived(title, body_text, html_path, md_path)
 
+    if pretty:
+        # Wrap text nodes to prevent very long lines
+        wrap_text_nodes(doc, width=WRAP_WIDTH)
 
-def pretty_and_derive():
+        # Pretty-print XML/HTML
+        if is_html:
+            pretty_bytes = etree.tostring(
+                doc, pretty_print=True, encoding="utf-8", method="html"
+            )
+        else:
+            pretty_bytes = etree.tostring(
+                doc,
+                pretty_print=True,
+                encoding="utf-8",
+                xml_declaration=True,
+            )
+
+        pretty_path.write_bytes(pretty_bytes)
+
+
+# Files handed to a worker at a time, and progress bar update granularity
+PROGRESS_BATCH = 32
+
+
+def _ignore_sigint():
+    """Pool initializer: let the parent process alone handle Ctrl-C."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def pretty_and_derive(pretty: bool = True):
     """Pretty-print XML and generate HTML/Markdown with a progress bar."""
 
-    XML_PRETTY_DIR.mkdir(parents=True, exist_ok=True)
-    HTML_DIR.mkdir(parents=True, exist_ok=True)
-    MD_DIR.mkdir(parents=True, exist_ok=True)
+    # data/xml_pretty/ is only written (and created) with pretty output
+    out_dirs = (XML_PRETTY_DIR, HTML_DIR, MD_DIR) if pretty else (HTML_DIR, MD_DIR)
+    for out_dir in out_dirs:
+        out_dir.mkdir(parents=True, exist_ok=True)
 
     files = list(XML_ORIG_DIR.rglob("*.xml"))
     total = len(files)
@@ -83,6 +533,11 @@ def pretty_and_derive():
 
     print(f"Processing {total} XML files…")
 
+    # Create every output directory up front, so workers never race on mkdir
+    for rel_dir in {xml_file.relative_to(XML_ORIG_DIR).parent for xml_file in files}:
+        for out_dir in out_dirs:
+            (out_dir / rel_dir).mkdir(parents=True, exist_ok=True)
+
     progress = Progress(
         TextColumn("[bold blue]{task.description}"),
         BarColumn(),
@@ -90,94 +545,23 @@ def pretty_and_derive():
         TimeElapsedColumn(),
         TimeRemainingColumn(),
         expand=True,
+        refresh_per_second=4,
     )
 
+    # Files are independent, and parsing/serializing is CPU-bound: use all cores
+    executor = ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_ignore_sigint)
+
     try:
         with progress:
             task = progress.add_task("Processing files", total=total)
 
-            for xml_file in files:
-                rel = xml_file.relative_to(XML_ORIG_DIR)
-
-                pretty_path = XML_PRETTY_DIR / rel
-                html_path = HTML_DIR / rel.with_suffix(".html")
-                md_path = MD_DIR / rel.with_suffix(".md")
-
-                pretty_path.parent.mkdir(parents=True, exist_ok=True)
-                html_path.parent.mkdir(parents=True, exist_ok=True)
-                md_path.parent.mkdir(parents=True, exist_ok=True)
-
-                raw = xml_file.read_bytes()
-                enc = detect_encoding(raw)
-
-                # Parse with fallback
-                try:
-                    doc = html.fromstring(raw.decode(enc, errors="replace"))
-                    is_html = True
-                except Exception:
-                    parser = etree.XMLParser(recover=True)
-                    doc = etree.fromstring(raw, parser=parser)
-                    is_html = False
-
-                # Wrap text nodes to prevent very long lines
-                wrap_text_nodes(doc, width=WRAP_WIDTH)
-
-                # Pretty-print XML/HTML
-                if is_html:
-                    pretty_bytes = etree.tostring(
-                        doc, pretty_print=True, encoding="utf-8", method="html"
-                    )
-                else:
-                    pretty_bytes = etree.tostring(
-                        doc,
-                        pretty_print=True,
-                        encoding="utf-8",
-                        xml_declaration=True,
-                    )
-
-                pretty_path.write_bytes(pretty_bytes)
-
-                # Generate simple HTML + Markdown
-                title_nodes = doc.xpath("//dd[@class='titleShort'] | //dd[@class='title'] | //h1")
-                title = title_nodes[0].text_content().strip() if title_nodes else rel.stem
-
-                body_nodes = doc.xpath("//main")
-                body_text = (
-                    body_nodes[0].text_content().strip()
-                    if body_nodes
-                    else doc.text_content().strip()
-                )
-
-                paragraphs = [
-                    fill(" ".join(p.split()), width=WRAP_WIDTH)
-                    for p in body_text.split("\n")
-                    if p.strip()
-                ]
-
-                # HTML output
-                html_out = [
-                    "<!DOCTYPE html>",
-                    '<html lang="no">',
-                    "<head>",
-                    '<meta charset="utf-8">',
-                    f"<title>{title}</title>",
-                    "<style>body{font-family:sans-serif;max-width:700px;margin:2rem auto;}p{margin-bottom:1rem;}</style>",
-                    "</head>",
-                    "<body>",
-                    f"<h1>{title}</h1>",
-                ]
-                html_out.extend(f"<p>{p}</p>" for p in paragraphs)
-                html_out.append("</body></html>")
-
-                html_path.write_text("\n".join(html_out), encoding="utf-8")
-
-                # Markdown output
-                md_out = [f"# {title}", ""]
-                md_out.extend(f"{p}\n" for p in paragraphs)
-
-                md_path.write_text("\n".join(md_out), encoding="utf-8")
-
-                progress.update(task, advance=1)
+            # Results arrive in chunks anyway; advance the bar per chunk too
+            work = functools.partial(process_one, pretty=pretty)
+            done = 0
+            for done, _ in enumerate(executor.map(work, files, chunksize=PROGRESS_BATCH), 1):
+                if done % PROGRESS_BATCH == 0:
+                    progress.update(task, advance=PROGRESS_BATCH)
+            progress.update(task, advance=done % PROGRESS_BATCH)
 
     except KeyboardInterrupt:
         progress.stop()
@@ -185,11 +569,23 @@ def pretty_and_derive():
         print("Partial output has been saved safely.")
         return
 
+    finally:
+        # Also reached when a file fails: drop the work still queued
+        executor.shutdown(wait=False, cancel_futures=True)
+
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--no-pretty",
+        action="store_true",
+        help="Only write HTML/Markdown; skip data/xml_pretty/ (needed by build_dataset.py and the MCP server)"
+    )
+    args = parser.parse_args()
+
     try:
         extract_tarballs()
-        pretty_and_derive()
+        pretty_and_derive(pretty=not args.no_pretty)
         print("Done prepare_xml.")
     except KeyboardInterrupt:
         print("\nStopped by user. Goodbye.")